@@ -1,18 +1,30 @@
+from __future__ import annotations
+
+import csv
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from hashlib import sha1
+from io import BytesIO
 from pathlib import Path
 from pprint import pformat
 from socket import gaierror, gethostbyname_ex
-from time import perf_counter
+from time import monotonic, perf_counter
 from textwrap import TextWrapper
+from typing import TYPE_CHECKING
 
-import numpy as np
-import pandas as pd
-from icmplib import Hop, Host, ping, traceroute
+from icmplib import Hop, Host, multiping, ping, traceroute
 
 from util.heptatet import HEPTATE_ENTRIES, Heptate
 from util.zscore_mean import Stats
 from util.logging_color import _debug, _error, _info, _warn, _extra
 
+# numpy and pandas are imported inside the analyze code paths only, so that
+# --help, collect and traceroute don't pay for importing them
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
 # ---------------------------- User Configurations --------------------------- #
 
 # Required file to read from
@@ -32,6 +44,16 @@ FREQUENT_SITES_DATA = 'frequent_sites_data.csv'
 BAD_POPULAR_SITES_DATA = f'bad_{POPULAR_SITES_DATA}'
 BAD_FREQUENT_SITES_DATA = f'bad_{FREQUENT_SITES_DATA}'
 
+# Typed columnar copy of a data file (a directory of parts), read by analyze instead of the CSV
+PARQUET_SUFFIX = '.parquet'
+# Hash of the CSV bytes the parts were parsed from, kept in the parts directory.
+# Leading underscore so Parquet readers skip it
+PARQUET_CHECK_FILE = '_csv_prefix.sha1'
+# Hash this many bytes at the start of the CSV and right before the parsed offset
+PARQUET_CHECK_BYTES: int = 4096
+# Merge the parts into one once there are more than this many
+MAX_PARQUET_PARTS: int = 32
+
 # Perform 4 pings per traceroute/ping for data collection
 NUM_PINGS: int = 4
 
@@ -41,12 +63,31 @@ REFERENCE_DAYS: int = 14
 # Z Score badness threshold
 BAD_ZSCORE: float = 2.0
 
+# Run at most 16 traceroutes at once, each one holds a raw socket
+MAX_CONCURRENT_TRACES: int = 16
+
+# Reuse DNS answers for 5 minutes
+DNS_TTL: float = 300.0
+
 # Should be one of min_rtt, avg_rtt, or max_rtt
 RTT_COL = 'avg_rtt'
 
+# How expected RTT and its spread are estimated from past data, should be one of
+# trimmed: mean and std after dropping RTTs over the 97.73 percentile
+# mad: median and median absolute deviation (scaled to match a std), robust to
+#      RTT spikes without trimming, but BAD_ZSCORE then means robust zscores
+RTT_STATS = 'trimmed'
+assert RTT_STATS in ('trimmed', 'mad'), f'Unrecognized RTT STATS: {RTT_STATS}'
+
+# MAD * 1.4826 estimates the std of normally distributed data
+MAD_SCALE: float = 1.4826
+# With fewer samples than this, or a MAD of 0, an ip's spread is unknown (NaN)
+# and its hops count as normal, like ips with too few samples left after trimming
+MAD_MIN_SAMPLES: int = 5
+
 """
 Heptatets (derivative, I know)
-time (pandas datetime): pandas datetime object
+time (datetime): timezone aware UTC datetime
 site/url (str): url of website
 ip (str): ip address of site/url
 hop_num (int): the hop from host, use `.distance` attribute when using icmplib. 0 if pinging
@@ -55,7 +96,15 @@ avg_rtt (float): use `.avg_rtt` attribute when using icmplib
 max_rtt (float): use `.max_rtt` attribute when using icmplib
 """
 DATA_COLUMNS = HEPTATE_ENTRIES  # ['time', 'site', 'ip', 'hop_num', 'min_rtt', 'avg_rtt', 'max_rtt']
+# Column types when reading data files, so pandas doesn't have to infer them.
+# Only a few hundred distinct sites and ips repeat over every row, so as categories
+# comparing and grouping works on small integer codes instead of Python strings.
+# hop_num never exceeds icmplib's 30 max hops, rtt is ms with 3 decimals.
+DATA_DTYPES = {'site': 'category', 'ip': 'category', 'hop_num': 'int8',
+               'min_rtt': 'float32', 'avg_rtt': 'float32', 'max_rtt': 'float32'}
 assert RTT_COL in DATA_COLUMNS, f'Unrecognized RTT COL: {RTT_COL}'
+# Columns analyze actually looks at, besides the time index
+ANALYZE_COLUMNS = ['site', 'ip', 'hop_num', RTT_COL]
 
 def main():
     # ######################################################## #
@@ -81,51 +130,21 @@ def main():
         data_dir.mkdir()
         print(_info(f'Created {DATA_DIR} directory'))
 
-    # Set up popular sites data file if necessary
+    # Set up data files if necessary
     popular_sites_data_file = data_dir.joinpath(POPULAR_SITES_DATA)
-    if not popular_sites_data_file.exists():
-        popular_sites_data_file.touch(exist_ok=False)
-        print(_info(f'Created {popular_sites_data_file} file'))
-
-    if popular_sites_data_file.stat().st_size == 0:
-        pd.DataFrame(columns=DATA_COLUMNS).to_csv(
-            popular_sites_data_file, index=False)
-
-    # Set up bad popular sites data file if necessary
     bad_popular_sites_data_file = data_dir.joinpath(BAD_POPULAR_SITES_DATA)
-    if not bad_popular_sites_data_file.exists():
-        bad_popular_sites_data_file.touch(exist_ok=False)
-        print(_info(f'Created {bad_popular_sites_data_file} file'))
-        
-    if bad_popular_sites_data_file.stat().st_size == 0:
-        pd.DataFrame(columns=DATA_COLUMNS).to_csv(
-            bad_popular_sites_data_file, index=False)
-
-    # Set up frequent sites data file if necessary
     frequent_sites_data_file = data_dir.joinpath(FREQUENT_SITES_DATA)
-    if not frequent_sites_data_file.exists():
-        frequent_sites_data_file.touch(exist_ok=False)
-        print(_info(f'Created {frequent_sites_data_file} file'))
-
-    if frequent_sites_data_file.stat().st_size == 0:
-        pd.DataFrame(columns=DATA_COLUMNS).to_csv(frequent_sites_data_file, index=False)
-
-    # Set up bad frequent sites data file if necessary
     bad_frequent_sites_data_file = data_dir.joinpath(BAD_FREQUENT_SITES_DATA)
-    if not bad_frequent_sites_data_file.exists():
-        bad_frequent_sites_data_file.touch(exist_ok=False)
-        print(_info(f'Created {bad_frequent_sites_data_file} file'))
-    
-    if bad_frequent_sites_data_file.stat().st_size == 0:
-        pd.DataFrame(columns=DATA_COLUMNS).to_csv(bad_frequent_sites_data_file, index=False)
+    for data_file in [popular_sites_data_file, bad_popular_sites_data_file,
+                      frequent_sites_data_file, bad_frequent_sites_data_file]:
+        _ensure_data_file(data_file)
 
     # ######################################################## #
     # ##################### Read in files #################### #
     # ######################################################## #
-    popular_sites_list: list[str] = list(
-        pd.read_csv(popular_sites, squeeze=True))
+    popular_sites_list: list[str] = read_sites(popular_sites)
 
-    frequent_sites_list: list[str] = list(pd.read_csv(frequent_sites, squeeze=True))
+    frequent_sites_list: list[str] = read_sites(frequent_sites)
 
     # ######################################################## #
     # #################### Parse Arguments ################### #
@@ -176,14 +195,23 @@ def _handle_analyze(args, popular_sites_data_file: Path, popular_sites_list: lis
     
     def __stats_str(heptate: Heptate, stats: Stats):
         return f'Measured {round(getattr(heptate, RTT_COL), 2)}ms, Expected: {round(stats.mean, 2)}ms, STD: {round(stats.std, 2)}ms, Zscore: {round(stats.zscore, 3)}'
-    
+
     fast_run: bool = args.fast_run
-    
-    popular_sites_data_df = pd.read_csv(popular_sites_data_file,
-                                        parse_dates=True,
-                                        infer_datetime_format=True,
-                                        index_col=DATA_COLUMNS[0])
-    popular_sites_data_df.sort_index(inplace=True)
+
+    site = args.site
+    is_new_site = site not in popular_sites_list and site not in frequent_sites_list
+
+    # frequent sites data is only needed for frequent and new sites, and not
+    # until after the pings, load it on a worker thread while they wait on the network
+    frequent_sites_data_future = None
+    if site not in popular_sites_list:
+        loader = ThreadPoolExecutor(max_workers=1)
+        frequent_sites_data_future = loader.submit(load_data_df, frequent_sites_data_file,
+                                                   ANALYZE_COLUMNS, x_days_ago(REFERENCE_DAYS))
+        loader.shutdown(wait=False)
+
+    popular_sites_data_df = load_data_df(popular_sites_data_file, ANALYZE_COLUMNS,
+                                         x_days_ago(REFERENCE_DAYS))
     # Only referenced days are being used from here on
     popular_sites_data_df = last_x_days_df(popular_sites_data_df, REFERENCE_DAYS)
     
@@ -192,7 +220,11 @@ def _handle_analyze(args, popular_sites_data_file: Path, popular_sites_list: lis
     # 1. Check ISP gateway aliveness and RTT first. 
     #    Exit if we can't even access the gateway.
     gateway_ip = get_gateway_ip(popular_sites_data_df)
-    gateway_ping_ok, gateway_heptate = ping_url(gateway_ip)
+    if is_new_site:
+        gateway_ping_ok, gateway_heptate = ping_url(gateway_ip)
+    else:
+        # site has past data and gets pinged too, do both at once
+        (gateway_ping_ok, gateway_heptate), (site_ping_ok, site_heptate) = ping_urls([gateway_ip, site])
     if not gateway_ping_ok:
         print(_error('Not connected to gateway. Exiting...'))
         return
@@ -205,21 +237,15 @@ def _handle_analyze(args, popular_sites_data_file: Path, popular_sites_list: lis
     else:
         print('✅', _info(f'Gateway ({gateway_ip}) okay'))
     
-    frequent_sites_data_df = pd.read_csv(frequent_sites_data_file,
-                                       parse_dates=True,
-                                       infer_datetime_format=True,
-                                       index_col=DATA_COLUMNS[0])
-    frequent_sites_data_df.sort_index(inplace=True)
-    frequent_sites_data_df = last_x_days_df(frequent_sites_data_df, REFERENCE_DAYS)
+    if frequent_sites_data_future is not None:
+        frequent_sites_data_df = frequent_sites_data_future.result()
+        frequent_sites_data_df = last_x_days_df(frequent_sites_data_df, REFERENCE_DAYS)
 
-    site = args.site
-    is_new_site = site not in popular_sites_list and site not in frequent_sites_list
-    
     df = None
     
     if is_new_site:
         # Use all collected data
-        df = pd.concat([popular_sites_data_df, frequent_sites_data_df], sort=True)
+        df = concat_data_dfs([popular_sites_data_df, frequent_sites_data_df])
         print(_warn(f'No past data on {site} ...'))
     else:
         if site in popular_sites_list:
@@ -229,8 +255,7 @@ def _handle_analyze(args, popular_sites_data_file: Path, popular_sites_list: lis
             print(_extra(f'{site} in frequent sites'))
             df = frequent_sites_data_df
             
-        ok, site_heptate = ping_url(site)
-        if ok:
+        if site_ping_ok:
             site_stats = ip_filtered_rtt_stats(df, site_heptate)
             if site_stats.zscore < BAD_ZSCORE:
                 print('✅', _info(f'Based on past data, RTT to {site} appears normal.'))
@@ -249,6 +274,11 @@ def _handle_analyze(args, popular_sites_data_file: Path, popular_sites_list: lis
     else:
         dest = None
     
+    # trimmed RTT stats of every known ip, computed once for all hops
+    ip_stats = ip_rtt_stats_table(df)
+    # unique works on the categorical codes, no Python loop over every row
+    known_ips = frozenset(df['ip'].unique())
+
     last_known_hop = None
     unknown_hops: list[Heptate] = []
     is_detached = False
@@ -259,9 +289,7 @@ def _handle_analyze(args, popular_sites_data_file: Path, popular_sites_list: lis
         if heptate == dest:
             # successfully reached site, don't process last hop
             break
-        cur_ip = heptate.ip
-        cur_ip_df = df[df['ip'] == cur_ip]
-        if cur_ip_df.shape[0] > 0:
+        if heptate.ip in known_ips:
             if is_detached: # reaching a site does not count as getting back to old path
                 is_detached = False
                 print(_info(f'Back to known hop: {heptate.ip}'))
@@ -276,7 +304,7 @@ def _handle_analyze(args, popular_sites_data_file: Path, popular_sites_list: lis
             # we compare the current RTT with past data. 
             # If zscore is high, we report this hop as the culprit. 
             # Otherwise continue the loop.
-            heptate_stats = ip_filtered_rtt_stats(df, heptate)
+            heptate_stats = lookup_rtt_stats(ip_stats, heptate)
             if heptate_stats.zscore >= BAD_ZSCORE:
                 print('❌', _warn(f'Hop at {heptate.ip} is experiencing unusually high RTT. {__stats_str(heptate, heptate_stats)}'))
                 failure_detected = True
@@ -360,36 +388,66 @@ def _collect_data(data_file: Path, bad_data_file: Path, sites_list: list[str]):
         _info(f'Start collecting on:\n'
               f'{pformat(sites_list)}'))
     start = perf_counter()
-    new_good_data = []
-    new_bad_data = []
-    for address in sites_list:
-        print(_debug(address), end=' ', flush=True)
-        s = perf_counter()
-        ok, hops = trace_url(address)
-        if ok:
-            new_good_data.extend(hops)
-        else:
-            new_bad_data.extend(hops)
-        e = perf_counter()
-        print(_debug(f'{round(e - s, 2)} seconds'))
-    if len(new_good_data) > 0:
-        pd.DataFrame(data=new_good_data).to_csv(
-            data_file, index=False, mode='a', header=False)
-    if len(new_bad_data) > 0:
-        pd.DataFrame(data=new_bad_data).to_csv(
-            bad_data_file, index=False, mode='a', header=False)
+    num_good, num_bad = _trace_to_files(data_file, bad_data_file, sites_list)
     end = perf_counter()
     print(_info(f'Done in {round(end - start, 2)} seconds.'))
-    if len(new_good_data) > 0:
-        print(_info(f'+ {len(new_good_data)} to {data_file}'))
-    if len(new_bad_data) > 0:
-        print(_warn(f'+ {len(new_bad_data)} to {bad_data_file}'))
+    if num_good > 0:
+        print(_info(f'+ {num_good} to {data_file}'))
+    if num_bad > 0:
+        print(_warn(f'+ {num_bad} to {bad_data_file}'))
+
+
+def _trace_to_files(data_file: Path, bad_data_file: Path, sites_list: list[str]) -> tuple[int, int]:
+    num_good = 0
+    num_bad = 0
+    timings: list[str] = []
+    # Traceroutes are dispatched concurrently, total time is about the slowest site.
+    # Each site's hops are written as soon as it finishes, so nothing piles up
+    # in memory and finished sites survive a crash. Heptate fields are already
+    # in DATA_COLUMNS order, so rows go straight to csv.writer.
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TRACES) as pool, \
+            data_file.open('a', newline='') as good_f, \
+            bad_data_file.open('a', newline='') as bad_f:
+        good_writer = csv.writer(good_f, lineterminator='\n')
+        bad_writer = csv.writer(bad_f, lineterminator='\n')
+        futures = [pool.submit(_timed_trace_url, a) for a in sites_list]
+        for done in as_completed(futures):
+            address, seconds, (ok, hops) = done.result()
+            timings.append(_debug(f'{address} {round(seconds, 2)} seconds'))
+            if ok:
+                good_writer.writerows(hops)
+                num_good += len(hops)
+            else:
+                bad_writer.writerows(hops)
+                num_bad += len(hops)
+    # one write for all sites, workers never contend for stdout
+    if timings:
+        print('\n'.join(timings))
+    return num_good, num_bad
 
 
 # ---------------------------------------------------------------------------- #
 # ----------------------------- Helper Functions ----------------------------- #
 # ---------------------------------------------------------------------------- #
 
+def _ensure_data_file(data_file: Path):
+    # create data_file if missing, and give it the CSV header if it's empty.
+    # 'x' creates atomically or fails, so existing files cost a single open
+    try:
+        with data_file.open('x') as f:
+            f.write(','.join(DATA_COLUMNS) + '\n')
+        print(_info(f'Created {data_file} file'))
+    except FileExistsError:
+        with data_file.open('a') as f:
+            if f.tell() == 0:
+                f.write(','.join(DATA_COLUMNS) + '\n')
+
+def read_sites(sites_file: Path) -> list[str]:
+    # single column of hostnames under a header, no need for pandas
+    with sites_file.open() as f:
+        next(f, None)  # skip header
+        return [line.strip() for line in f if line.strip()]
+
 """
 When doing traceroute or ping, check if the last hop ip is one of
 ip(s) returned by gethostbyname_ex to make sure traceroute didn't timeout
@@ -397,18 +455,40 @@ and ping is pinging the right ip
 """
 
 
+# address -> (time resolved, ips from gethostbyname_ex)
+_DNS_CACHE: dict[str, tuple[float, frozenset[str]]] = {}
+# resolves names in the background while the traceroute itself runs
+_DNS_POOL = ThreadPoolExecutor(max_workers=8)
+
+
+def _resolve(address: str) -> frozenset[str]:
+    now = monotonic()
+    cached = _DNS_CACHE.get(address)
+    if cached is not None and now - cached[0] < DNS_TTL:
+        return cached[1]
+    # a set, CDNs can return lots of A records and callers only test membership
+    _, _, ips = gethostbyname_ex(address)
+    res = frozenset(ips)
+    _DNS_CACHE[address] = (now, res)
+    return res
+
+
 def trace_url(address: str, num_pings=NUM_PINGS):
-    _, _, possible_ips = gethostbyname_ex(address)
+    # DNS and traceroute don't depend on each other, overlap them
+    dns_future = _DNS_POOL.submit(_resolve, address)
     hops: list[Hop] = traceroute(address, count=num_pings)
+    possible_ips = dns_future.result()
     ok = True
     if hops[-1].address not in possible_ips:
         # last hop of traceroute not in DNS address record
         # traceroute might've timed out or DNS is out of date
         # regardless, something is wrong
         print(
-            _warn(f'Traceroute failure {address} ip mismatch: {hops[-1].address} not one of {possible_ips}'))
+            _warn(f'Traceroute failure {address} ip mismatch: {hops[-1].address} not one of {sorted(possible_ips)}'))
         ok = False
-    return ok, [Heptate(__utc_time_now(),
+    # all hops share one timestamp for this traceroute
+    now = __utc_time_now()
+    return ok, [Heptate(now,
                     address,
                     h.address,
                     h.distance,
@@ -417,9 +497,30 @@ def trace_url(address: str, num_pings=NUM_PINGS):
                     h.max_rtt) for h in hops]
 
 
+def _timed_trace_url(address: str, num_pings=NUM_PINGS):
+    # icmplib's traceroute is sync only, but each call owns its socket and
+    # blocks in recv with the GIL released, so it runs fine in a worker thread
+    s = perf_counter()
+    res = trace_url(address, num_pings)
+    e = perf_counter()
+    return address, e - s, res
+
+
 def ping_url(address: str, num_pings=NUM_PINGS) -> tuple[bool, Heptate]:
     t = __utc_time_now()
     host = ping(address, count=num_pings)
+    return _host_heptate(t, address, host)
+
+def ping_urls(addresses: list[str], num_pings=NUM_PINGS) -> list[tuple[bool, Heptate]]:
+    # all addresses are pinged concurrently over one socket,
+    # results come back in the same order as addresses
+    t = __utc_time_now()
+    # same 1 second interval as ping, multiping defaults to 0.5
+    hosts: list[Host] = multiping(addresses, count=num_pings, interval=1,
+                                  concurrent_tasks=len(addresses))
+    return [_host_heptate(t, address, host) for address, host in zip(addresses, hosts)]
+
+def _host_heptate(t: datetime, address: str, host: Host) -> tuple[bool, Heptate]:
     if not host.is_alive:
         # Failed to reach address
         print(
@@ -433,52 +534,213 @@ def ping_url(address: str, num_pings=NUM_PINGS) -> tuple[bool, Heptate]:
                    host.max_rtt)
 
 def __utc_time_now():
-    return pd.to_datetime('now', utc=True)
+    # prints the same as a UTC pandas Timestamp, without importing pandas
+    return datetime.now(timezone.utc)
+
+def load_data_df(data_file: Path, columns: list[str] = None, since: datetime = None) -> pd.DataFrame:
+    # columns (besides the time index) to load, all of them if None.
+    # since: rows older than this may be skipped while reading, callers
+    # still slice the result themselves.
+    # CSV stays the append-only log written by collect. Next to it sits a
+    # directory of Parquet parts holding the same rows parsed and typed, one
+    # part per byte range of the CSV, named by the offset it ends at. Only rows
+    # appended since the last load get parsed, and each load writes at most one
+    # small part instead of rewriting all history.
+    import pandas as pd
+    parts_dir = data_file.with_suffix(PARQUET_SUFFIX)
+    parts_dir.mkdir(exist_ok=True)
+    check_file = parts_dir.joinpath(PARQUET_CHECK_FILE)
+    parts = sorted(parts_dir.glob(f'*{PARQUET_SUFFIX}'))
+    offset = int(parts[-1].stem) if parts else 0
+    if parts and (not check_file.exists()
+                  or check_file.read_text() != _csv_prefix_hash(data_file, offset)):
+        # CSV got truncated, rewritten or replaced (a restored backup, data from
+        # another machine), the parts don't match it anymore, start over
+        for part in parts:
+            part.unlink()
+        parts, offset = [], 0
+
+    new_df, end = _read_data_csv(data_file, offset)
+    if new_df.shape[0] > 0:
+        part = parts_dir.joinpath(f'{end:020d}{PARQUET_SUFFIX}')
+        new_df.to_parquet(part)
+        parts.append(part)
+        # written after the part, if interrupted in between the hash won't
+        # match the new offset and the next load starts over
+        check_file.write_text(_csv_prefix_hash(data_file, end))
+    if len(parts) > MAX_PARQUET_PARTS:
+        parts = [_merge_parts(parts_dir, parts)]
+    if not parts:
+        return new_df if columns is None else new_df[columns]
+    # columnar, so unused columns are never read off disk, and the time
+    # filter is checked against each part's statistics first, so parts
+    # entirely older than since are skipped without being read
+    filters = None if since is None else [(DATA_COLUMNS[0], '>=', since)]
+    df = pd.read_parquet(parts_dir, columns=columns, filters=filters)
+    # parts come back in offset order, so this only sorts when concurrently
+    # traced sites got appended slightly out of time order
+    if not df.index.is_monotonic_increasing:
+        df.sort_index(inplace=True)
+    return df
+
+def _merge_parts(parts_dir: Path, parts: list[Path]) -> Path:
+    # rewrite all parts as one named by the last offset, so reads don't
+    # open one more small file for every analyze that saw new rows
+    import pandas as pd
+    merged = parts_dir.joinpath('_merging.tmp')
+    pd.read_parquet(parts_dir).to_parquet(merged)
+    # without the hash an interrupted merge just starts over from the CSV
+    check_file = parts_dir.joinpath(PARQUET_CHECK_FILE)
+    check = check_file.read_text()
+    check_file.unlink()
+    for part in parts:
+        part.unlink()
+    merged.replace(parts[-1])
+    check_file.write_text(check)
+    return parts[-1]
+
+def _csv_prefix_hash(data_file: Path, offset: int) -> str:
+    # identifies the first offset bytes of data_file by its start, the bytes
+    # leading up to offset and offset itself. Cheap enough for every load,
+    # and a different file won't line up on all three
+    with data_file.open('rb') as f:
+        head = f.read(min(offset, PARQUET_CHECK_BYTES))
+        f.seek(max(offset - PARQUET_CHECK_BYTES, 0))
+        tail = f.read(offset - f.tell())
+    return sha1(b'%d\n%b%b' % (offset, head, tail)).hexdigest()
+
+def concat_data_dfs(dfs: list[pd.DataFrame]) -> pd.DataFrame:
+    import pandas as pd
+    from pandas.api.types import union_categoricals
+    # concat falls back to object columns when categories differ, so recode
+    # every frame onto the union of categories first (codes only, no strings).
+    # Rows stay in frame order, stats are per ip and don't need them time sorted
+    dtypes = {col: pd.CategoricalDtype(union_categoricals([df[col] for df in dfs]).categories)
+              for col, dtype in DATA_DTYPES.items()
+              if dtype == 'category' and col in dfs[0].columns}
+    return pd.concat([df.astype(dtypes) for df in dfs])
+
+def _read_data_csv(data_file: Path, offset: int) -> tuple[pd.DataFrame, int]:
+    # parse data_file from byte offset on, returns rows and the offset parsed up to
+    import pandas as pd
+    with data_file.open('rb') as f:
+        f.seek(offset)
+        data = f.read()
+    # a collect run may be appending right now, stop at the last full line
+    end = offset + data.rfind(b'\n') + 1
+    if end == offset:
+        return pd.DataFrame(columns=DATA_COLUMNS).set_index(DATA_COLUMNS[0]).astype(DATA_DTYPES), end
+    df = pd.read_csv(BytesIO(data[:end - offset]),
+                     header=0 if offset == 0 else None,
+                     names=DATA_COLUMNS,
+                     # fixed types also keep every Parquet part on the same schema,
+                     # categories come back from Parquet as dictionary columns
+                     dtype=DATA_DTYPES,
+                     parse_dates=[DATA_COLUMNS[0]],
+                     index_col=DATA_COLUMNS[0],
+                     # multithreaded, and parses the ISO timestamps natively (~10x faster)
+                     engine='pyarrow')
+    return df, end
+
+def x_days_ago(days: int) -> datetime:
+    assert days >= 0, f'days: {days} must be non-negative integer'
+    # midnight (UTC) of the day x days ago, references cover whole days
+    day = (__utc_time_now() - timedelta(days=days)).date()
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
 
 def last_x_days_df(df: pd.DataFrame, days: int):
     assert df.shape[0] > 0, 'In last_x_days_df: passed in Dataframe is empty'
-    assert days >= 0, f'days: {days} must be non-negative integer'
-    now = __utc_time_now()
-    x_days_ago = now - days * pd.offsets.Day()
-    x_days_ago_str = x_days_ago.strftime('%Y-%m-%d')
-    res = df[x_days_ago_str:]
+    # index is sorted, so binary search the cutoff and take a positional slice
+    # instead of formatting and re-parsing a date string for label slicing
+    res = df.iloc[df.index.searchsorted(x_days_ago(days)):]
     assert res.shape[0] > 0, f'In last_x_days_df: last {days} returns empty Dataframe'
     return res
 
 def ip_filtered_rtt_stats(df, heptate: Heptate, 
                                 match_site=False, rtt_col=RTT_COL):
     assert df.shape[0] > 0, 'In ip_filtered_rtt_stats: passed in Dataframe is empty'
-    mask = (df['ip'] == heptate.ip)
+    # categorical compares are on the integer codes, then plain arrays from here
+    mask = (df['ip'] == heptate.ip).to_numpy()
     if match_site:
-        mask = mask & (df['site'] == heptate.site)
-    target_df = df[mask]
-    assert target_df.shape[0] > 0, 'Dataframe is empty after filter'
-    rtt_series = target_df[rtt_col]
-    
+        mask &= (df['site'] == heptate.site).to_numpy()
+    # stats in float64, float32 scalars print with float32 noise (18.020000457763672)
+    rtts = df[rtt_col].to_numpy()[mask].astype('float64')
+    assert rtts.size > 0, 'Dataframe is empty after filter'
+    if RTT_STATS == 'mad':
+        mean, std = median_mad_std(rtts)
+    else:
+        mean, std = trimmed_mean_std(rtts)
+    zscore = (getattr(heptate, rtt_col) - mean) / std
+    return Stats(zscore, mean, std)
+
+def trimmed_mean_std(rtts: np.ndarray) -> tuple[float, float]:
+    import numpy as np
     # remove rtt over 97.73 percentile (outliers over 3-std)
     # rtt data resembles poisson distribution, so try to remove top percentiles
-    rtt_series_quantile = rtt_series.quantile(0.9773)
-    filterd_rtt_series = rtt_series[rtt_series < rtt_series_quantile]
-    filterd_rtt_series_mean = filterd_rtt_series.mean()
-    filterd_rtt_series_std = filterd_rtt_series.std()
-    zscore = (getattr(heptate, rtt_col) - filterd_rtt_series_mean) / filterd_rtt_series_std
-    return Stats(zscore, filterd_rtt_series_mean, filterd_rtt_series_std)
+    filtered_rtts = rtts[rtts < np.quantile(rtts, 0.9773)]
+    if filtered_rtts.size < 2:
+        # too few samples for a std, same NaN result pandas gives
+        return (filtered_rtts[0] if filtered_rtts.size else np.nan), np.nan
+    return filtered_rtts.mean(), filtered_rtts.std(ddof=1)
+
+def median_mad_std(rtts: np.ndarray) -> tuple[float, float]:
+    import numpy as np
+    # two selections over the data, no trimming needed since the median
+    # ignores spikes
+    median = np.median(rtts)
+    mad = np.median(np.abs(rtts - median))
+    if rtts.size < MAD_MIN_SAMPLES or mad == 0:
+        return median, np.nan
+    return median, MAD_SCALE * mad
+
+def ip_rtt_stats_table(df: pd.DataFrame, rtt_col=RTT_COL) -> pd.DataFrame:
+    assert df.shape[0] > 0, 'In ip_rtt_stats_table: passed in Dataframe is empty'
+    # float64 like ip_filtered_rtt_stats, so hops and the gateway/site get the
+    # same numbers. observed, so ips outside the loaded window don't get empty rows
+    ips = df['ip']
+    rtts = df[rtt_col].astype('float64')
+    grouped = rtts.groupby(ips, sort=False, observed=True)
+    if RTT_STATS == 'mad':
+        # same as median_mad_std, for all ips in one grouped pass
+        medians = grouped.median()
+        abs_devs = (rtts - medians.reindex(ips).to_numpy()).abs()
+        mads = abs_devs.groupby(ips, sort=False, observed=True).median()
+        known_spread = (mads > 0) & (grouped.size() >= MAD_MIN_SAMPLES)
+        return medians.to_frame('mean').assign(std=(MAD_SCALE * mads).where(known_spread))
+    # same 97.73 percentile trim as trimmed_mean_std, for all ips in one grouped pass
+    cutoffs = grouped.quantile(0.9773)
+    keep = rtts.to_numpy() < cutoffs.reindex(ips).to_numpy()
+    return rtts[keep].groupby(ips[keep], sort=False, observed=True).agg(['mean', 'std'])
+
+def lookup_rtt_stats(ip_stats: pd.DataFrame, heptate: Heptate, rtt_col=RTT_COL) -> Stats:
+    import numpy as np
+    if heptate.ip not in ip_stats.index:
+        # every sample of this ip got trimmed
+        return Stats(np.nan, np.nan, np.nan)
+    # NumPy scalars, so a 0 spread gives inf rather than ZeroDivisionError
+    mean, std = ip_stats.loc[heptate.ip].to_numpy(dtype='float64')
+    zscore = (getattr(heptate, rtt_col) - mean) / std
+    return Stats(zscore, mean, std)
 
 def extract_last_hops(df: pd.DataFrame) -> pd.DataFrame:
+    import numpy as np
     assert df.shape[0] > 0, 'In extract_last_hops: passed in Dataframe is empty'
-    # shift hop_num temp forward once
-    df['hop_num_temp'] = df['hop_num'].shift(-1)
-    # last hop_num of temp would be N/A, so hardcode it to 1
-    df.iloc[-1, df.columns.get_loc('hop_num_temp')] = 1
-    # filter
-    res_df = df[df['hop_num'] > df['hop_num_temp']]
-    return res_df
+    # a row is the last hop of its traceroute when the next row's hop_num
+    # starts over, the final row is compared against a next hop_num of 1.
+    # Compare on the array directly, no temporary column on the caller's df
+    hop_nums = df['hop_num'].to_numpy()
+    is_last = np.empty(hop_nums.size, dtype=bool)
+    is_last[:-1] = hop_nums[:-1] > hop_nums[1:]
+    is_last[-1] = hop_nums[-1] > 1
+    return df[is_last]
 
 def get_gateway_ip(df: pd.DataFrame):
+    import numpy as np
     assert df.shape[0] > 0, 'In get_gateway_ip: passed in Dataframe is empty'
-    hop_one = df[df['hop_num'] == 1]
-    hop_one_ip_col = hop_one['ip']
-    return hop_one_ip_col.iloc[-1]
+    # most recent hop 1, found on the hop_num array without copying
+    # every column of the matching rows into a new Dataframe
+    hop_one_rows = np.flatnonzero(df['hop_num'].to_numpy() == 1)
+    return df['ip'].iat[hop_one_rows[-1]]
 
 """
 def site_max_rtt_stats(url: str, past_df: pd.DataFrame) -> tuple[float, float, float]:
@@ -1,9 +1,9 @@
+from datetime import datetime
 from typing import NamedTuple
-from pandas import DatetimeIndex
 
 """
 Heptatets (derivative, I know)
-time (pandas datetime): pandas datetime object
+time (datetime): timezone aware UTC datetime
 site/url (str): url of website
 ip (str): ip address of site/url
 hop_num (int): the hop from host, use `.distance` attribute when using icmplib. 0 if pinging
@@ -16,7 +16,7 @@ HEPTATE_ENTRIES = ['time', 'site', 'ip', 'hop_num', 'min_rtt', 'avg_rtt', 'max_r
 # Heptate = namedtuple('Heptatet', HEPTATE_ENTRIES)
 
 class Heptate(NamedTuple):
-    time: DatetimeIndex
+    time: datetime
     site: str
     ip: str
     hop_num: int